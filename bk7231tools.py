@@ -1,17 +1,26 @@
 import argparse
 import base64
-import io
+import mmap
 import os
+import queue
+import stat
+import struct
 import sys
+import threading
 import traceback
 from contextlib import closing
 from pathlib import Path
-from typing import List
+from typing import Iterable, List
 
 from bk7231tools.analysis import flash, rbl, utils
 from bk7231tools.crypto.code import BekenCodeCipher
 from bk7231tools.serial import BK7231Serial
 
+PADDING_BLOCK = b"\xFF" * 16
+CODE_PARTITION_CHUNK_SIZE = 64 * 1024
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+CODE_PARTITION_COEFFICIENTS = struct.unpack(">4I", base64.b64decode("UQ+wk6PL6txZk6F+x63rAw=="))
+
 
 def __add_serial_args(parser: argparse.ArgumentParser):
     parser.add_argument("-d", "--device", required=True, help="Serial device path")
@@ -32,8 +41,7 @@ def __add_serial_args(parser: argparse.ArgumentParser):
 
 
 def __ensure_output_dir_exists(output_dir):
-    if not os.path.exists(output_dir):
-        os.mkdir(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
     return output_dir
 
 
@@ -43,131 +51,144 @@ def __generate_payload_output_file_path(dumpfile: str, payload_name: str, output
 
 
 def __decrypt_code_partition(partition: flash.FlashPartition, payload: bytes):
-    CODE_PARTITION_COEFFICIENTS = base64.b64decode("UQ+wk6PL6txZk6F+x63rAw==")
-    coefficients = (CODE_PARTITION_COEFFICIENTS[i:i+4] for i in range(0, len(CODE_PARTITION_COEFFICIENTS), 4))
-    coefficients = tuple(int.from_bytes(i, byteorder='big') for i in coefficients)
-
-    cipher = BekenCodeCipher(coefficients)
-    padded_payload = cipher.pad(payload)
-    return cipher.decrypt(padded_payload, partition.mapped_address)
-
-
-def __carve_and_write_rbl_containers(dumpfile: str, layout: flash.FlashLayout, output_directory: str, extract: bool = False, with_rbl: bool = False) -> List[rbl.Container]:
+    # Yields (chunk, decrypted chunk) pairs so that callers can handle both in a single pass
+    cipher = BekenCodeCipher(CODE_PARTITION_COEFFICIENTS)
+    # Chunks are sliced out of a view, slicing the payload directly would copy every chunk
+    payload_view = memoryview(payload)
+    for offset in range(0, len(payload), CODE_PARTITION_CHUNK_SIZE):
+        chunk = payload_view[offset:offset+CODE_PARTITION_CHUNK_SIZE]
+        yield chunk, cipher.decrypt(cipher.pad(chunk), partition.mapped_address + offset)
+
+
+def __write_code_partition(partition: flash.FlashPartition, payload: bytes, filepath: str, decryptedpath: str, header: bytes = b""):
+    with open(filepath, "wb", buffering=OUTPUT_BUFFER_SIZE) as fsout, \
+            open(decryptedpath, "wb", buffering=OUTPUT_BUFFER_SIZE) as fsdecrypted:
+        fsout.write(header)
+        for chunk, decrypted in __decrypt_code_partition(partition, payload):
+            fsout.write(chunk)
+            fsdecrypted.write(decrypted)
+
+
+def __carve_and_write_rbl_containers(dumpfile: str, dump: mmap.mmap, layout: flash.FlashLayout, output_directory: str,
+                                     extract: bool = False, with_rbl: bool = False) -> List[rbl.Container]:
     containers = []
-    with open(dumpfile, "rb") as fs:
-        indices = rbl.find_rbl_containers_indices(fs)
-        if indices:
-            print("RBL containers:")
-            for idx in indices:
-                print(f"\t{idx:#x}: ", end="")
-                container = None
-                try:
-                    fs.seek(idx, os.SEEK_SET)
-                    container = rbl.Container.from_bytestream(fs, layout)
-                except ValueError as e:
-                    print(f"FAILED TO PARSE - {e.args[0]}")
-                if container is not None:
-                    containers.append(container)
-                    if container.payload is not None:
-                        print(
-                            f"{container.header.name} - [encoding_algorithm={container.header.algo.name}, size={len(container.payload):#x}]")
-                        partition = layout.partitions[0]
-                        for p in layout.partitions:
-                            if p.name == container.header.name:
-                                partition = p
-                                break
-                        if extract:
-                            extra_tag = container.header.version
-                            filepath = __generate_payload_output_file_path(
-                                dumpfile=dumpfile, payload_name=container.header.name, output_directory=output_directory, extra_tag=extra_tag)
-                            with open(filepath, "wb") as fsout:
-                                container.write_to_bytestream(fsout, payload_only=(not with_rbl))
-
-                            extra_tag = f"{container.header.version}_decrypted"
-                            decryptedpath = __generate_payload_output_file_path(
-                                dumpfile=dumpfile, payload_name=container.header.name, output_directory=output_directory, extra_tag=extra_tag)
-                            with open(decryptedpath, "wb") as fsout:
-                                fsout.write(__decrypt_code_partition(partition, container.payload))
-
-                            print(f"\t\textracted to {output_directory}")
-                    else:
-                        print(f"{container.header.name} - INVALID PAYLOAD")
+    partitions_by_name = {p.name: p for p in layout.partitions}
+    dump.seek(0, os.SEEK_SET)
+    indices = rbl.find_rbl_containers_indices(dump)
+    if indices:
+        print("RBL containers:")
+        for idx in indices:
+            print(f"\t{idx:#x}: ", end="")
+            container = None
+            try:
+                dump.seek(idx, os.SEEK_SET)
+                container = rbl.Container.from_bytestream(dump, layout)
+            except ValueError as e:
+                print(f"FAILED TO PARSE - {e.args[0]}")
+            if container is not None:
+                containers.append(container)
+                if container.payload is not None:
+                    print(
+                        f"{container.header.name} - [encoding_algorithm={container.header.algo.name}, size={len(container.payload):#x}]")
+                    partition = partitions_by_name.get(container.header.name, layout.partitions[0])
+                    if extract:
+                        extra_tag = container.header.version
+                        filepath = __generate_payload_output_file_path(
+                            dumpfile=dumpfile, payload_name=container.header.name, output_directory=output_directory, extra_tag=extra_tag)
+
+                        extra_tag = f"{container.header.version}_decrypted"
+                        decryptedpath = __generate_payload_output_file_path(
+                            dumpfile=dumpfile, payload_name=container.header.name, output_directory=output_directory, extra_tag=extra_tag)
+
+                        header = container.header.to_bytes() if with_rbl else b""
+                        __write_code_partition(partition, container.payload, filepath, decryptedpath, header=header)
+
+                        print(f"\t\textracted to {output_directory}")
+                else:
+                    print(f"{container.header.name} - INVALID PAYLOAD")
     return containers
 
 
-def __scan_pattern_find_payload(dumpfile: str, partition_name: str, layout: flash.FlashLayout, output_directory: str, extract: bool = False):
-    if not partition_name in {p.name for p in layout.partitions}:
+def __rfind_aligned_block(data: bytes, block: bytes, end: int, alignment_base: int) -> int:
+    # Returns the highest position i <= end where data[i-len(block):i] == block and i is
+    # aligned to len(block) relative to alignment_base, or -1 if there is none.
+    position = data.rfind(block, 0, end)
+    while position >= 0:
+        block_end = position + len(block)
+        if (alignment_base - block_end) % len(block) == 0:
+            return block_end
+        position = data.rfind(block, 0, block_end - 1)
+    return -1
+
+
+def __rfind_not_padding(data: bytes, end: int) -> int:
+    # Returns the position of the last byte before end which isn't 0xFF, or -1 if there is none.
+    # Strips growing windows so that only about as many bytes as the 0xFF run are copied.
+    window = 64
+    while end > 0:
+        start = max(0, end - window)
+        remaining = len(data[start:end].rstrip(b"\xFF"))
+        if remaining:
+            return start + remaining - 1
+        end = start
+        window *= 2
+    return -1
+
+
+def __scan_pattern_find_payload(dumpfile: str, dump: mmap.mmap, partition_name: str, layout: flash.FlashLayout,
+                                output_directory: str, extract: bool = False):
+    partition = {p.name: p for p in layout.partitions}.get(partition_name, None)
+    if partition is None:
         raise ValueError(f"Partition name {partition_name} is unknown in layout {layout.name}")
 
-    final_payload_data = None
-    partition = list(filter(lambda p: p.name == partition_name, layout.partitions))[0]
-    with open(dumpfile, "rb") as fs:
-        fs.seek(partition.start_address, os.SEEK_SET)
-        data = fs.read(partition.size)
-        i = partition.size
-        while i > 0:
-            datablock = data[i-16:i]
-            # Scan for a block of 16 FF bytes, indicating padding at the end of a partition.
-            # This is to ignore RBL headers and other metadata while scanning.
-            if datablock == (b"\xFF" * 16):
-                break
-            i -= 16
-        if i <= 0:
-            raise ValueError(f"Could not find end of partition for {partition.name}")
-
-        # Now do a pattern scan until we hit the first CRC-16 block
-        # and the padding block right before it
-        while i > 0:
-            datablock = data[i-16:i]
-            if datablock != (b"\xFF" * 16) and data[i-32:i-16] == (b"\xFF" * 16):
-                # This is exactly after the last 0xFF padding block including its CRC-16 checksum
-                i = (i - 16 + 2)
-                break
-            i -= 16
-        payload = data[:i]
-
-        # Extra check for dealing with weird dumps, this essentially
-        # changes the pattern scan to purely a moving block read
-        # and CRC validation from the start of the partition
-        if not payload:
-            fs.seek(partition.start_address, os.SEEK_SET)
-            payload = fs.read(partition.size)
-
-        block_io_stream = io.BytesIO(payload)
-        final_payload = io.BytesIO()
-        block = block_io_stream.read(32)
-        first = True
-        while block:
-            crc_bytes = block_io_stream.read(2)
-            if not utils.block_crc_check(block, crc_bytes):
-                if first:
-                    raise ValueError(f"First block level CRC-16 checks failed while analyzing partition {partition.name}")
-                else:
-                    # One of the CRC checks after the first one has failed, so either
-                    # end of stream has been reached or the dump is mangled.
-                    # In both cases, not much to do hence bail out assuming it's fine
-                    break
-            first = False
-            final_payload.write(block)
-            block = block_io_stream.read(32)
-
-        final_payload_data = final_payload.getbuffer()
-
-    if final_payload_data is not None:
-        print(f"\t{partition.start_address:#x}: {partition.name} - [NO RBL, size={len(final_payload_data):#x}]")
-        if extract:
-            extra_tag = "pattern_scan"
-            filepath = __generate_payload_output_file_path(dumpfile, payload_name=partition_name,
-                                                           output_directory=output_directory, extra_tag=extra_tag)
-            with open(filepath, "wb") as fs:
-                fs.write(final_payload_data)
-
-            extra_tag = "pattern_scan_decrypted"
-            decryptedpath = __generate_payload_output_file_path(dumpfile, payload_name=partition_name,
-                                                                output_directory=output_directory, extra_tag=extra_tag)
-            with open(decryptedpath, "wb") as fs:
-                fs.write(__decrypt_code_partition(partition, final_payload_data))
-            print(f"\t\textracted to {output_directory}")
+    data = dump[partition.start_address:partition.start_address + partition.size]
+    # Scan for a block of 16 FF bytes, indicating padding at the end of a partition.
+    # This is to ignore RBL headers and other metadata while scanning.
+    i = __rfind_aligned_block(data, PADDING_BLOCK, end=partition.size, alignment_base=partition.size)
+    if i <= 0:
+        raise ValueError(f"Could not find end of partition for {partition.name}")
+
+    # Now do a pattern scan until we hit the first CRC-16 block
+    # and the padding block right before it. The FF run ending at i is crossed in one go by
+    # looking for the last byte that isn't 0xFF, the block holding it is the first candidate.
+    last_data_byte = __rfind_not_padding(data, end=i)
+    if last_data_byte < 0:
+        i = -1
+    else:
+        i = last_data_byte - (last_data_byte - partition.size) % 16
+        if i < 16 or data[i-16:i] != PADDING_BLOCK:
+            # Any aligned padding block below is necessarily followed by a block which isn't padding
+            i = __rfind_aligned_block(data, PADDING_BLOCK, end=i, alignment_base=partition.size)
+    # This is exactly after the last 0xFF padding block including its CRC-16 checksum
+    payload = data[:i + 2] if i > 0 else b""
+
+    # Extra check for dealing with weird dumps, this essentially
+    # changes the pattern scan to purely a moving block read
+    # and CRC validation from the start of the partition
+    if not payload:
+        payload = data
+
+    # Validate all blocks in one pass. If one of the CRC checks after the first one
+    # has failed then either end of stream has been reached or the dump is mangled.
+    # In both cases, not much to do hence stop there assuming it's fine
+    valid_blocks = utils.count_valid_crc_blocks(payload)
+    if valid_blocks == 0:
+        raise ValueError(f"First block level CRC-16 checks failed while analyzing partition {partition.name}")
+
+    # Strip the CRC-16 checksums by joining the validated blocks straight out of the payload
+    final_payload_data = b"".join(payload[offset:offset+32] for offset in range(0, valid_blocks * 34, 34))
+
+    print(f"\t{partition.start_address:#x}: {partition.name} - [NO RBL, size={len(final_payload_data):#x}]")
+    if extract:
+        extra_tag = "pattern_scan"
+        filepath = __generate_payload_output_file_path(dumpfile, payload_name=partition_name,
+                                                       output_directory=output_directory, extra_tag=extra_tag)
+
+        extra_tag = "pattern_scan_decrypted"
+        decryptedpath = __generate_payload_output_file_path(dumpfile, payload_name=partition_name,
+                                                            output_directory=output_directory, extra_tag=extra_tag)
+        __write_code_partition(partition, final_payload_data, filepath, decryptedpath)
+        print(f"\t\textracted to {output_directory}")
 
     return final_payload_data
 
@@ -186,14 +207,16 @@ def dissect_dump_file(args):
     if args.extract:
         output_directory = __ensure_output_dir_exists(output_directory)
 
-    containers = __carve_and_write_rbl_containers(dumpfile=dumpfile, layout=layout,
-                                                  output_directory=output_directory, extract=args.extract, with_rbl=args.rbl)
-    container_names = {container.header.name for container in containers if container.payload is not None}
-    missing_rbl_containers = {part.name for part in layout.partitions} - container_names
-    for missing in missing_rbl_containers:
-        print(f"Missing {missing} RBL container. Using a scan pattern instead")
-        __scan_pattern_find_payload(dumpfile, partition_name=missing, layout=layout,
-                                    output_directory=output_directory, extract=args.extract)
+    # Map the dump once and share it, instead of reopening and reading it for every partition
+    with open(dumpfile, "rb") as fs, mmap.mmap(fs.fileno(), 0, access=mmap.ACCESS_READ) as dump:
+        containers = __carve_and_write_rbl_containers(dumpfile=dumpfile, dump=dump, layout=layout,
+                                                      output_directory=output_directory, extract=args.extract, with_rbl=args.rbl)
+        container_names = {container.header.name for container in containers if container.payload is not None}
+        missing_rbl_containers = {part.name for part in layout.partitions} - container_names
+        for missing in missing_rbl_containers:
+            print(f"Missing {missing} RBL container. Using a scan pattern instead")
+            __scan_pattern_find_payload(dumpfile, dump, partition_name=missing, layout=layout,
+                                        output_directory=output_directory, extract=args.extract)
 
 
 def connect_device(device, baudrate, timeout):
@@ -204,10 +227,67 @@ def chip_info(device: BK7231Serial, args: List[str]):
     print(device.read_chip_info())
 
 
+def __write_fully(fd: int, data: bytes):
+    # os.write may write only part of the data, keep going until all of it is written
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def __write_chunks_in_background(fd: int, data_chunks: Iterable[bytes]):
+    # Chunks are written to disk by a separate thread, so that reading
+    # from the serial port never has to wait for the disk
+    chunks = queue.Queue(maxsize=8)
+    write_error = None
+
+    def write_chunks():
+        nonlocal write_error
+        data = chunks.get()
+        while data is not None:
+            # Keep draining the queue after a failure, a dead writer would block the reader on a full queue
+            if write_error is None:
+                try:
+                    __write_fully(fd, data)
+                except BaseException as e:
+                    write_error = e
+            data = chunks.get()
+
+    writer = threading.Thread(target=write_chunks, daemon=True)
+    writer.start()
+    try:
+        for data in data_chunks:
+            if write_error is not None:
+                break
+            chunks.put(data)
+    finally:
+        chunks.put(None)
+        writer.join()
+    if write_error is not None:
+        raise write_error
+
+
 def read_flash(device: BK7231Serial, args: List[str]):
-    with open(args.file, "wb") as fs:
-        for data in device.flash_read(args.start_address, args.count * 4096, not args.no_verify_checksum):
-            fs.write(data)
+    size = args.count * 4096
+    fd = os.open(args.file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o666)
+    try:
+        # Only regular files can be preallocated, the dump may as well be written to a pipe
+        is_regular_file = stat.S_ISREG(os.fstat(fd).st_mode)
+        if is_regular_file and hasattr(os, "posix_fallocate"):
+            # Reserve disk space for the whole dump upfront, so running out of it fails before reading
+            os.posix_fallocate(fd, 0, size)
+        try:
+            __write_chunks_in_background(fd, device.flash_read(args.start_address, size, not args.no_verify_checksum))
+        finally:
+            if is_regular_file:
+                # Do not leave preallocated zeroes behind after a failed read
+                os.ftruncate(fd, os.lseek(fd, 0, os.SEEK_CUR))
+        if is_regular_file and hasattr(os, "posix_fadvise"):
+            # The dump is written once, no point in keeping it around in the page cache.
+            # Dirty pages are not dropped, so flush them out first.
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, size, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
 
 
 def parse_args():
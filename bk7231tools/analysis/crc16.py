@@ -1,19 +1,27 @@
 # https://stackoverflow.com/a/60604183
+def _generate_crc16_table(poly: int):
+    table = []
+    for octet in range(256):
+        reg = octet << 8
+        for _ in range(8):
+            reg <<= 1
+            if reg & 0x10000:
+                reg ^= poly
+        table.append(reg & 0xFFFF)
+    return tuple(table)
+
+
+_CRC16_POLY = 0x8005  # generator polinom (normal form)
+_CRC16_TABLE = _generate_crc16_table(_CRC16_POLY)
+
+
 def crc16(data: bytes, initial_value: int = 0x0000) -> int:
     xor_in = initial_value  # initial value
     xor_out = 0x0000  # final XOR value
-    poly = 0x8005  # generator polinom (normal form)
 
+    # Table driven, processes a whole octet per lookup instead of a bit at a time
+    table = _CRC16_TABLE
     reg = xor_in
     for octet in data:
-        # reflect in
-        for i in range(8):
-            topbit = reg & 0x8000
-            if octet & (0x80 >> i):
-                topbit ^= 0x8000
-            reg <<= 1
-            if topbit:
-                reg ^= poly
-        reg &= 0xFFFF
-        # reflect out
+        reg = ((reg << 8) & 0xFFFF) ^ table[(reg >> 8) ^ octet]
     return reg ^ xor_out
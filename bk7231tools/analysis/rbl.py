@@ -60,9 +60,6 @@ class Header:
                 f"Header crc32 {info_crc32:#x} does not match calculated header crc32 {calculated_crc:#x}")
 
 
-__HEADER_MAGIC_NEEDLE = bytes([Header.MAGIC[0]]), Header.MAGIC[1:]
-
-
 class Container(object):
     def __init__(self, header: Header, payload: bytes):
         self.header = header
@@ -154,16 +151,15 @@ class Container(object):
 
 def find_rbl_containers_indices(bytestream: io.BytesIO) -> List[int]:
     oldpos = bytestream.tell()
+    # Memory mapped streams can be searched in place, anything else is read into memory first
+    if hasattr(bytestream, "find"):
+        data, start = bytestream, oldpos
+    else:
+        data, start = bytestream.read(), 0
+        bytestream.seek(oldpos, os.SEEK_SET)
     rbl_locations = []
-    magic_needle = __HEADER_MAGIC_NEEDLE[0]
-    magic_remainder = __HEADER_MAGIC_NEEDLE[1]
-    c = bytestream.read(len(magic_needle))
-    while c:
-        location = bytestream.tell() - 1
-        if c == magic_needle:
-            remainder = bytestream.read(len(magic_remainder))
-            if remainder == magic_remainder:
-                rbl_locations.append(location)
-        c = bytestream.read(len(magic_needle))
-    bytestream.seek(oldpos, os.SEEK_SET)
+    location = data.find(Header.MAGIC, start)
+    while location != -1:
+        rbl_locations.append(oldpos - start + location)
+        location = data.find(Header.MAGIC, location + 1)
     return rbl_locations
@@ -7,3 +7,14 @@ def block_crc_check(block: bytes, crc_bytes: bytes) -> bool:
     calculated = crc16(block, initial_value=0xffff)
     unpacked_crc = (struct.unpack(">H", crc_bytes)[0] & 0xffff)
     return calculated == unpacked_crc
+
+
+def count_valid_crc_blocks(data: bytes, block_size: int = 32) -> int:
+    # Counts the leading blocks of data, each followed by its CRC-16, until one fails its check or is incomplete
+    stride = block_size + 2
+    count = 0
+    for offset in range(0, len(data) - stride + 1, stride):
+        if not block_crc_check(data[offset:offset+block_size], data[offset+block_size:offset+stride]):
+            break
+        count += 1
+    return count
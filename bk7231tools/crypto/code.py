@@ -1,4 +1,4 @@
-from operator import truediv
+import struct
 from typing import Tuple
 from .util import uint8, uint16, uint32
 
@@ -50,101 +50,94 @@ def _generate_uint_pn32(index_mask, flag):
 
 class BekenCodeCipher(object):
     BLOCK_LENGTH_BYTES = 32
+    WORD_SIZE = 4
+    PN32_SHIFTS = ((0, 0), (8, 24), (16, 16), (24, 8))
 
     def __init__(self, coefficients: Tuple[int, int, int, int]):
         self._coef0, self._coef1, self._coef2, self._coef3 = coefficients
 
+        # Everything derived from coef3 is constant for the lifetime of the cipher,
+        # so compute it once instead of on every word.
+        coef3_highbyte_cond = ((self._coef3 & 0xff000000) == 0xff000000) or ((self._coef3 & 0xff000000) == 0)
+        self._coef3_1_bit = coef3_highbyte_cond or (self._coef3 & 1 != 0)
+        self._coef3_2_bit = coef3_highbyte_cond or (self._coef3 & 2 != 0)
+        self._coef3_4_bit = coef3_highbyte_cond or (self._coef3 & 4 != 0)
+        self._coef3_8_bit = coef3_highbyte_cond or (self._coef3 & 8 != 0)
+
+        self._coef3_5_rsh = (self._coef3 >> 5) & 3
+        self._coef3_8_rsh = (self._coef3 >> 8) & 3
+        self._pn32_shifts = self.PN32_SHIFTS[(self._coef3 >> 11) & 3]
+
+        pn16_index_mask = uint8(self._coef1) + (uint8(self._coef1 >> 8) * 0x200)
+        pn16_index_mask += uint8((self._coef3 >> 4) & 1) * 0x100
+        self._pn16_index_mask = pn16_index_mask
+        self._pn15_coef = self._coef1 >> 16
+        self._final_val = 0 if self._coef3_8_bit else self._coef2
+
     def encrypt(self, data: bytes, stream_start_offset: int = 0):
         if (len(data) % self.BLOCK_LENGTH_BYTES) != 0:
             raise ValueError(f"Given data length {len(data)} is not a multiple of block length {self.BLOCK_LENGTH_BYTES}")
         
-        encrypted = bytearray()
-        for i in range(0, len(data), self.BLOCK_LENGTH_BYTES):
-            block = data[i:i+self.BLOCK_LENGTH_BYTES]
-            block_start_offset = (i + stream_start_offset)
-            encrypted.extend(self._encrypt_block(block, block_start_offset))
-        
-        return encrypted
+        # Unpack and repack all words in one go, the stream offset of each word
+        # is all that is needed to encrypt it independently of its block.
+        word_count = len(data) // self.WORD_SIZE
+        words = struct.unpack(f"<{word_count}I", data)
+        encrypt_word = self._encrypt_word
+        encrypted = [encrypt_word(stream_start_offset + i * self.WORD_SIZE, word) for i, word in enumerate(words)]
+
+        result = bytearray(len(data))
+        struct.pack_into(f"<{word_count}I", result, 0, *encrypted)
+        return result
     
     def decrypt(self, data: bytes, stream_start_offset: int = 0):
         return self.encrypt(data, stream_start_offset=stream_start_offset)
 
     def pad(self, data: bytes):
         data_rem = len(data) % self.BLOCK_LENGTH_BYTES
-        result = data
-        if data_rem != 0:
-            result += b"\xFF" * (self.BLOCK_LENGTH_BYTES - data_rem)
-        return result
+        if data_rem == 0:
+            # Already aligned, hand back the data as is instead of copying it
+            return data
+        return bytes(data) + b"\xFF" * (self.BLOCK_LENGTH_BYTES - data_rem)
 
     def _encrypt_block(self, block: bytes, block_start_offset: int):
         if len(block) != self.BLOCK_LENGTH_BYTES:
             raise ValueError(f"Block length must be exactly {self.BLOCK_LENGTH_BYTES} bytes")
         
-        WORD_SIZE = 4
-
-        encrypted = bytearray()
-        for i in range(0, len(block), WORD_SIZE):
-            word = int.from_bytes(block[i:i+WORD_SIZE], byteorder="little")
-            encrypted_word = self._encrypt_word(block_start_offset + i, word)
-            encrypted.extend(encrypted_word.to_bytes(WORD_SIZE, byteorder="little"))
-
-        return encrypted
+        return self.encrypt(block, block_start_offset)
 
     def _encrypt_word(self, index: int, word: int):
-        coef3_highbyte_cond = False
-        coef3_1_bit, coef3_2_bit, coef3_4_bit, coef3_8_bit = False, False, False, False
-
-        if (((self._coef3 & 0xff000000) == 0xff000000) or ((self._coef3 & 0xff000000) == 0)):
-            coef3_highbyte_cond = True
-        
-        if coef3_highbyte_cond:
-            coef3_1_bit = coef3_2_bit = coef3_4_bit = coef3_8_bit = True
-        if self._coef3 & 1 != 0:
-            coef3_1_bit = True
-        if self._coef3 & 2 != 0:
-            coef3_2_bit = True
-        if self._coef3 & 4 != 0:
-            coef3_4_bit = True
-        if self._coef3 & 8 != 0:
-            coef3_8_bit = True
-
-        coef3_4_rsh = self._coef3 >> 4
-        coef3_5_rsh = (self._coef3 >> 5) & 3
-        coef3_8_rsh = (self._coef3 >> 8) & 3
-        coef3_11_rsh = (self._coef3 >> 11) & 3
-        index_mask_16_rsh = uint16(index >> 16)
-        index_mask_seq = uint16(index >> 8)
-
-        if coef3_5_rsh == 0:
-            pn15_word = (uint8(index_mask_16_rsh) + uint16((index >> 24) << 8)) ^ uint16(index)
-        elif coef3_5_rsh == 1:
-            pn15_word = (uint8(index_mask_16_rsh) + uint16((index >> 24) << 8))
-            pn15_word ^= (uint8(index_mask_seq) + uint16(index << 8))
-        elif coef3_5_rsh == 2:
-            pn15_word = ((index_mask_16_rsh >> 8) + uint16((index >> 16) << 8)) ^ uint16(index)
-        else:
-            pn15_word = ((index_mask_16_rsh >> 8) + uint16((index >> 16) << 8))
-            pn15_word ^= (uint8(index_mask_seq) + uint16(index << 8))
-
-        pn16_word = (index >> coef3_8_rsh) & 0x1ffff
-        PN32_SHIFTS = ((0, 0), (8, 24), (16, 16), (24, 8))
-        pn32_word = uint32(index >> PN32_SHIFTS[coef3_11_rsh][0] | index << PN32_SHIFTS[coef3_11_rsh][1])
-
-        pn15_index_mask = uint16((self._coef1 >> 16) ^ pn15_word)
-
-        pn16_index_mask = uint8(self._coef1) + (uint8(self._coef1 >> 8) * 0x200)
-        pn16_index_mask += uint8(coef3_4_rsh & 1) * 0x100
-        pn16_index_mask ^= pn16_word
-
-        pn32_index_mask = pn32_word ^ self._coef0
-
-        pn15_val = _generate_uint_pn15(pn15_index_mask, coef3_1_bit)
-        pn16_val = _generate_uint_pn16(pn16_index_mask, coef3_2_bit)
-        pn32_val = _generate_uint_pn32(pn32_index_mask, coef3_4_bit)
-
-        final_val = 0 if coef3_8_bit else self._coef2
-
-        word_encryption_mask = pn15_val * 0x10000
-        word_encryption_mask += pn16_val
-
-        return word_encryption_mask ^ pn32_val ^ final_val ^ word
\ No newline at end of file
+        # Each PN generator is either always enabled or always disabled for a given set of
+        # coefficients, so only the enabled ones are evaluated at all.
+        word_encryption_mask = 0
+
+        if not self._coef3_1_bit:
+            index_mask_16_rsh = uint16(index >> 16)
+            index_mask_seq = uint16(index >> 8)
+
+            coef3_5_rsh = self._coef3_5_rsh
+            if coef3_5_rsh == 0:
+                pn15_word = (uint8(index_mask_16_rsh) + uint16((index >> 24) << 8)) ^ uint16(index)
+            elif coef3_5_rsh == 1:
+                pn15_word = (uint8(index_mask_16_rsh) + uint16((index >> 24) << 8))
+                pn15_word ^= (uint8(index_mask_seq) + uint16(index << 8))
+            elif coef3_5_rsh == 2:
+                pn15_word = ((index_mask_16_rsh >> 8) + uint16((index >> 16) << 8)) ^ uint16(index)
+            else:
+                pn15_word = ((index_mask_16_rsh >> 8) + uint16((index >> 16) << 8))
+                pn15_word ^= (uint8(index_mask_seq) + uint16(index << 8))
+
+            pn15_index_mask = uint16(self._pn15_coef ^ pn15_word)
+            word_encryption_mask = _generate_uint_pn15(pn15_index_mask, False) * 0x10000
+
+        if not self._coef3_2_bit:
+            pn16_word = (index >> self._coef3_8_rsh) & 0x1ffff
+            pn16_index_mask = self._pn16_index_mask ^ pn16_word
+            word_encryption_mask += _generate_uint_pn16(pn16_index_mask, False)
+
+        if not self._coef3_4_bit:
+            pn32_rsh, pn32_lsh = self._pn32_shifts
+            pn32_word = uint32(index >> pn32_rsh | index << pn32_lsh)
+            pn32_index_mask = pn32_word ^ self._coef0
+            word_encryption_mask ^= _generate_uint_pn32(pn32_index_mask, False)
+
+        return word_encryption_mask ^ self._final_val ^ word